@@ -1,33 +1,67 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response, stream_with_context
 from werkzeug.security import generate_password_hash, check_password_hash
 import sqlite3
 import os
 import json
+import csv
+import io
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import click
 import requests
 import re
 import time
+import threading
+import secrets
+import hashlib
+import contextvars
+from collections import OrderedDict
 
 from kb_loader import load_kb
 from retriever import retrieve
+from kb_suggest import SuggestionIndex
+from singleflight import SingleFlight, flight_key
+from llm_scheduler import LLMScheduler, LLMOverloaded, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND, PRIORITY_BATCH
+from kb_compile import load_or_compile_kb, compile_kb, save_kb_artifact, compute_doc_features, keyword_mask, SCORING_KEYWORD_GROUPS, KB_CONTEXT_DOC_CHARS
 
 app = Flask(__name__)
 app.secret_key = "change_this_to_a_random_secret"
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, "app.db")
+KB_ARTIFACT_PATH = os.path.join(BASE_DIR, "kb.compiled.pkl")
 
 print("RUNNING THIS FILE:", __file__)
 print("DB PATH:", DB_PATH)
 
 KB_DOCS = load_kb("knowledgeBaseFiles")
+KB_FEATURES = load_or_compile_kb(KB_DOCS, KB_ARTIFACT_PATH)["docs"]
+SUGGEST_INDEX = SuggestionIndex(KB_DOCS)
 
 
 #loading the model locally
 
 
 OLLAMA_URL = "http://localhost:11434/api/generate"
-OLLAMA_MODEL = "llama3"
+OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL", "llama3")
+
+# model tiers: each stage starts on STAGE_TIERS[stage] and escalates to "large"
+# when the small model's output does not validate
+OLLAMA_MODELS = {
+    "small": os.environ.get("OLLAMA_SMALL_MODEL", "llama3.2:3b"),
+    "large": OLLAMA_MODEL,
+}
+STAGE_TIERS = {
+    "extract": os.environ.get("OLLAMA_EXTRACT_TIER", "small"),
+    "matrix": os.environ.get("OLLAMA_MATRIX_TIER", "small"),
+}
+SMALL_MATRIX_MAX_CELLS = 12
+MATRIX_MAX_DEFAULTED_RATIO = 0.25
+
+DECISION_TYPES = ["relationship", "career", "education", "purchase", "health", "finance", "travel", "other"]
+
+# keep the model (and its cached prompt prefix) loaded between requests
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
 
 EXTRACT_TIMEOUT = 180
 MATRIX_TIMEOUT = 300
@@ -35,6 +69,44 @@ MATRIX_TIMEOUT = 300
 EXTRACT_RETRIES = 2
 MATRIX_RETRIES = 2
 
+# set LLM_SINGLEFLIGHT_DIR to also coalesce identical calls across worker processes
+SINGLEFLIGHT_GRACE = 5
+LLM_SINGLEFLIGHT = SingleFlight(lock_dir=os.environ.get("LLM_SINGLEFLIGHT_DIR") or None)
+
+# should match OLLAMA_NUM_PARALLEL on the ollama server so batch workers map onto its slots
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", "4"))
+
+# longest a call may wait for an ollama slot before it is shed with a 429
+LLM_QUEUE_DEADLINE = {
+    PRIORITY_INTERACTIVE: 60,
+    PRIORITY_BACKGROUND: 20,
+    PRIORITY_BATCH: 900,
+}
+
+# the scheduler is per process: when the app runs under several worker processes, set
+# APP_WORKERS so their combined slots still add up to OLLAMA_NUM_PARALLEL
+APP_WORKERS = max(1, int(os.environ.get("APP_WORKERS", "1")))
+LLM_SLOTS = max(1, OLLAMA_NUM_PARALLEL // APP_WORKERS)
+
+LLM_SCHEDULER = LLMScheduler(LLM_SLOTS)
+
+# (user_id, priority) of whoever is asking for LLM work on this thread
+LLM_CALLER = contextvars.ContextVar("llm_caller", default=(None, PRIORITY_INTERACTIVE))
+
+BATCH_MAX_ITEMS = 500
+BATCH_COMMIT_SIZE = 25
+
+RESULT_CACHE_SIZE = 256
+STATIC_MAX_AGE = 31536000
+
+ANALYTICS_TOP_CRITERIA = 10
+
+# comma-separated emails allowed to read /admin/analytics
+ADMIN_EMAILS = {e.strip().lower() for e in os.environ.get("ADMIN_EMAILS", "").split(",") if e.strip()}
+
+PREPARE_TTL = 300
+PREPARE_WAIT_TIMEOUT = EXTRACT_TIMEOUT
+
 
 def _norm(s: str) -> str:
     return re.sub(r"\s+", " ", (s or "").strip().lower())
@@ -65,41 +137,34 @@ def guess_decision_type(question: str) -> str:
     return "other"
 
 
+def doc_features(d: dict) -> dict:
+    f = KB_FEATURES.get(d.get("path") or "")
+    return f if f is not None else compute_doc_features(d)
+
+
 def pick_scoring_docs(retrieved_docs, question: str, max_docs=2):
     if not retrieved_docs:
         return []
 
     q = (question or "").lower()
-    scored = []
+    govt_private_q = any(k in q for k in ["govt", "government", "private"])
 
-    for d in retrieved_docs:
-        path = (d.get("path") or "").lower()
-        title = (d.get("title") or "").lower()
-        cat = (d.get("category") or "").lower()
-        text = (d.get("text") or "").lower()
-        hint = " ".join([path, title, cat])
+    kw = []
+    for triggers, keywords in SCORING_KEYWORD_GROUPS:
+        if any(t in q for t in triggers):
+            kw += keywords
+    mask = keyword_mask(kw)
 
+    scored = []
+    for d in retrieved_docs:
+        f = doc_features(d)
         score = 0
 
-        if any(k in q for k in ["govt", "government", "private"]):
-            if "govt_vs_private" in hint or ("government" in hint and "private" in hint):
-                score += 120
-
-        kw = []
-        if "stability" in q or "security" in q:
-            kw += ["stability", "security", "job security"]
-        if "salary" in q or "pay" in q or "package" in q:
-            kw += ["salary", "pay", "compensation", "income"]
-        if "growth" in q or "career" in q:
-            kw += ["growth", "career", "promotion"]
-        if "pressure" in q or "stress" in q:
-            kw += ["pressure", "stress", "work pressure"]
-
-        for w in kw:
-            if w in text:
-                score += 12
-
-        score += min(len(text) // 1000, 5)
+        if govt_private_q and f["govt_private_hint"]:
+            score += 120
+
+        score += 12 * (f["kw_bits"] & mask).bit_count()
+        score += f["length_bonus"]
         scored.append((score, d))
 
     scored.sort(key=lambda x: x[0], reverse=True)
@@ -121,28 +186,98 @@ def safe_json_from_text(text: str) -> dict:
             return {}
 
 
-def ollama_generate(prompt: str, timeout: int, retries: int = 0):
+PREFILL_STATS = {}
+PREFILL_LOCK = threading.Lock()
+
+
+def record_prefill(stage: str, payload: dict, out: dict):
+    # ollama only counts prompt tokens it actually evaluated, so a reused prefix shows up as a
+    # lower prompt_eval_count. the first call per stage/prompt version/model is kept apart as the
+    # measured cold baseline the later, possibly cache-warm, calls are compared against
+    version = PROMPT_VERSIONS.get(stage, "none")
+    key = (stage, version, payload.get("model"))
+    tokens = int(out.get("prompt_eval_count") or 0)
+    ms = (out.get("prompt_eval_duration") or 0) / 1e6
+
+    with PREFILL_LOCK:
+        st = PREFILL_STATS.get(key)
+        if st is None:
+            PREFILL_STATS[key] = {"cold_tokens": tokens, "cold_ms": ms, "calls": 0, "prompt_eval_tokens": 0, "prompt_eval_ms": 0.0}
+            return
+        st["calls"] += 1
+        st["prompt_eval_tokens"] += tokens
+        st["prompt_eval_ms"] += ms
+
+
+def prefill_metrics() -> dict:
+    with PREFILL_LOCK:
+        out = {}
+        for (stage, version, model), st in sorted(PREFILL_STATS.items()):
+            out.setdefault(stage, []).append({
+                "prompt_version": version,
+                "model": model,
+                "cold_prompt_eval_tokens": st["cold_tokens"],
+                "cold_prompt_eval_ms": round(st["cold_ms"], 1),
+                "later_calls": st["calls"],
+                "avg_later_prompt_eval_tokens": round(st["prompt_eval_tokens"] / st["calls"], 1) if st["calls"] else None,
+                "avg_later_prompt_eval_ms": round(st["prompt_eval_ms"] / st["calls"], 1) if st["calls"] else None,
+            })
+        return out
+
+
+def _ollama_post(payload: dict, timeout: int, retries: int = 0, stage: str = "other"):
     last_err = None
     for attempt in range(retries + 1):
         try:
-            r = requests.post(
-                OLLAMA_URL,
-                json={"model": OLLAMA_MODEL, "prompt": prompt, "stream": False},
-                timeout=timeout
-            )
+            r = requests.post(OLLAMA_URL, json=payload, timeout=timeout)
             r.raise_for_status()
-            return (r.json().get("response") or "").strip()
+            out = r.json()
+            record_prefill(stage, payload, out)
+            return (out.get("response") or "").strip()
         except Exception as e:
             last_err = e
             time.sleep(0.8 * (attempt + 1))
     raise last_err
 
 
+def run_as_llm_caller(user_id, priority: int, fn, *args):
+    token = LLM_CALLER.set((user_id, priority))
+    try:
+        return fn(*args)
+    finally:
+        LLM_CALLER.reset(token)
+
+
+def tier_ladder(stage: str, cells: int = 0) -> list[str]:
+    start = STAGE_TIERS.get(stage, "large")
+    if stage == "matrix" and cells > SMALL_MATRIX_MAX_CELLS:
+        start = "large"
+    return ["small", "large"] if start == "small" else ["large"]
+
+
+def ollama_generate(prompt: str, timeout: int, retries: int = 0, model: str | None = None, system: str | None = None, stage: str = "other"):
+    payload = {"model": model or OLLAMA_MODEL, "prompt": prompt, "stream": False, "keep_alive": OLLAMA_KEEP_ALIVE}
+    if system:
+        payload["system"] = system
+    user_id, priority = LLM_CALLER.get()
+
+    # identical concurrent prompts (double submits, popular comparisons) share one generation,
+    # and only that one generation takes a scheduler slot. flights are per priority class so an
+    # interactive caller never waits behind, or gets shed with, a batch leader's queue ticket
+    return LLM_SINGLEFLIGHT.do(
+        f"p{priority}-{flight_key(payload)}",
+        lambda: LLM_SCHEDULER.run(user_id, priority, LLM_QUEUE_DEADLINE[priority], lambda: _ollama_post(payload, timeout, retries, stage)),
+        timeout=LLM_QUEUE_DEADLINE[priority] + timeout * (retries + 1) + SINGLEFLIGHT_GRACE
+    )
+
+
 #prompt given to the model
+# static instructions go in the system prompt and never change between requests, so ollama
+# can reuse their evaluated prefix; bump the version whenever the text changes
 
 
-def extract_decision_details(question: str) -> dict:
-    prompt = f"""You are an information extraction engine.
+EXTRACT_PROMPT_VERSION = "extract-v2"
+EXTRACT_SYSTEM = f"""You are an information extraction engine.
 Return ONLY valid minified JSON. No explanations. No markdown. No code fences.
 
 Schema:
@@ -150,15 +285,57 @@ Schema:
 
 Rules:
 - decision = short description of the choice (can be the question rephrased)
-- decision_type = one of: ["relationship","career","education","purchase","health","finance","travel","other"]
+- decision_type = one of: {json.dumps(DECISION_TYPES)}
 - If uncertain, use "other".
-- constraints, preferences, and entities must ALWAYS be arrays (possibly empty).
+- constraints, preferences, and entities must ALWAYS be arrays (possibly empty)."""
 
-Text: {question}"""
+MATRIX_PROMPT_VERSION = "matrix-v2"
+MATRIX_SYSTEM = """You are a scoring assistant for a transparent decision-support system.
+
+Use ONLY the provided KB context. Do NOT use external knowledge.
+Return ONLY valid minified JSON. No markdown.
+
+IMPORTANT RULES:
+- Use option names EXACTLY as they appear in the Options array (character-for-character).
+- Use criterion names EXACTLY as they appear in the Criteria array (character-for-character).
+- Output MUST include every pair (option, criterion). That means len(Options) * len(Criteria) items.
+
+Score scale: 1 (worst) to 5 (best).
+
+Schema:
+{"scores":[{"option":string,"criterion":string,"score":int,"reason":string}]}"""
+
+PROMPT_VERSIONS = {"extract": EXTRACT_PROMPT_VERSION, "matrix": MATRIX_PROMPT_VERSION}
+
+
+def extract_decision_details(question: str) -> tuple[dict, dict]:
+    prompt = f"Text: {question}"
+
+    ladder = tier_ladder("extract")
+    for tier in ladder:
+        last = tier == ladder[-1]
+        try:
+            # escalation is the retry for the small tier
+            text = ollama_generate(
+                prompt, timeout=EXTRACT_TIMEOUT, retries=EXTRACT_RETRIES if last else 0,
+                model=OLLAMA_MODELS[tier], system=EXTRACT_SYSTEM, stage="extract"
+            )
+        except LLMOverloaded:
+            raise
+        except Exception as e:
+            print(f"OLLAMA ERROR (extract, {tier}):", e)
+            continue
 
-    try:
-        text = ollama_generate(prompt, timeout=EXTRACT_TIMEOUT, retries=EXTRACT_RETRIES)
         parsed = safe_json_from_text(text)
+        if not isinstance(parsed, dict):
+            # valid JSON but not an object (e.g. ["career"]): escalate, or fall back after the last tier
+            print(f"EXTRACT {'ESCALATING from' if not last else 'FALLBACK after'} {tier}: non-object output")
+            continue
+        if not isinstance(parsed.get("decision_type"), str):
+            parsed["decision_type"] = None
+        if not last and (parsed["decision_type"] or "").strip().lower() not in DECISION_TYPES:
+            print(f"EXTRACT ESCALATING from {tier}: unusable output")
+            continue
 
         if parsed.get("constraints") is None:
             parsed["constraints"] = []
@@ -180,30 +357,29 @@ Text: {question}"""
         if not parsed.get("goal"):
             parsed["goal"] = "Choose the best option based on the user's priorities."
 
-        return parsed
+        return parsed, {"tier": tier, "model": OLLAMA_MODELS[tier], "prompt_version": EXTRACT_PROMPT_VERSION}
 
-    except Exception as e:
-        print("OLLAMA ERROR (extract):", e)
-        return {
-            "decision": question.strip(),
-            "decision_type": guess_decision_type(question),
-            "goal": "Choose the best option based on the user's priorities.",
-            "constraints": [],
-            "preferences": [],
-            "entities": [],
-            "time_horizon": None,
-            "risk_level": None
-        }
+    return {
+        "decision": question.strip(),
+        "decision_type": guess_decision_type(question),
+        "goal": "Choose the best option based on the user's priorities.",
+        "constraints": [],
+        "preferences": [],
+        "entities": [],
+        "time_horizon": None,
+        "risk_level": None
+    }, {"tier": "fallback", "model": None}
 
 
-def build_kb_context(kb_docs: list[dict], per_doc_chars: int = 900, max_total_chars: int = 1800) -> str:
+def build_kb_context(kb_docs: list[dict], per_doc_chars: int = KB_CONTEXT_DOC_CHARS, max_total_chars: int = 1800) -> str:
     chunks = []
     total = 0
     for d in kb_docs:
-        title = d.get("title", "")
-        cat = d.get("category", "")
-        txt = (d.get("text") or "").strip()
-        piece = f"[{cat}] {title}\n{txt[:per_doc_chars]}"
+        if per_doc_chars == KB_CONTEXT_DOC_CHARS:
+            piece = doc_features(d)["context_piece"]
+        else:
+            txt = (d.get("text") or "").strip()
+            piece = f"[{d.get('category', '')}] {d.get('title', '')}\n{txt[:per_doc_chars]}"
         if total + len(piece) > max_total_chars:
             break
         chunks.append(piece)
@@ -268,35 +444,21 @@ def keyword_fallback_scores(question: str, options: list[str], criteria: list[st
     return out
 
 
-def llm_fill_matrix(question: str, options: list[str], criteria: list[str], kb_docs: list[dict]) -> dict:
-    kb_context = build_kb_context(kb_docs)
+def llm_fill_matrix(question: str, options: list[str], criteria: list[str], kb_docs: list[dict], kb_context: str | None = None, model: str | None = None, retries: int = MATRIX_RETRIES) -> dict:
+    if kb_context is None:
+        kb_context = build_kb_context(kb_docs)
 
-    prompt = f"""
-You are a scoring assistant for a transparent decision-support system.
-
-Use ONLY the provided KB context. Do NOT use external knowledge.
-Return ONLY valid minified JSON. No markdown.
-
-IMPORTANT RULES:
-- Use option names EXACTLY as they appear in the Options array (character-for-character).
-- Use criterion names EXACTLY as they appear in the Criteria array (character-for-character).
-- Output MUST include every pair (option, criterion). That means len(Options) * len(Criteria) items.
-
-Score scale: 1 (worst) to 5 (best).
-
-Schema:
-{{"scores":[{{"option":string,"criterion":string,"score":int,"reason":string}}]}}
+    # KB context goes first: it is shared by every decision of the same type,
+    # so only the question/options/criteria tail changes between calls
+    prompt = f"""KB context:
+{kb_context}
 
 Question: {question}
 Options: {options}
-Criteria: {criteria}
-
-KB context:
-{kb_context}
-""".strip()
+Criteria: {criteria}"""
 
     try:
-        text = ollama_generate(prompt, timeout=MATRIX_TIMEOUT, retries=MATRIX_RETRIES)
+        text = ollama_generate(prompt, timeout=MATRIX_TIMEOUT, retries=retries, model=model, system=MATRIX_SYSTEM, stage="matrix")
         print("KB CONTEXT LEN:", len(kb_context))
         print("LLM RAW OUTPUT (first 800):", text[:800])
 
@@ -307,6 +469,8 @@ KB context:
             parsed["scores"] = []
         return parsed
 
+    except LLMOverloaded:
+        raise
     except Exception as e:
         print("OLLAMA ERROR (matrix):", e)
         return {"scores": []}
@@ -343,6 +507,19 @@ def validate_matrix(llm_out: dict, options: list[str], criteria: list[str]) -> l
     return out
 
 
+def count_valid_cells(llm_out: dict, options: list[str], criteria: list[str]) -> int:
+    wanted = {(_norm(o), _norm(c)) for o in options for c in criteria}
+    got = set()
+    for item in (llm_out.get("scores") or []):
+        if not isinstance(item, dict):
+            continue
+        score = item.get("score")
+        key = (_norm(item.get("option") or ""), _norm(item.get("criterion") or ""))
+        if key in wanted and isinstance(score, int) and 1 <= score <= 5:
+            got.add(key)
+    return len(got)
+
+
 def compute_ranking(options, criteria, option_scores):
     crit_w = {c["name"]: int(c.get("importance") or 3) for c in criteria}
     by_option = {}
@@ -378,6 +555,585 @@ def compute_ranking(options, criteria, option_scores):
     return totals
 
 
+#shared helpers for single and batch submit
+
+
+def check_decision_input(question: str, options_list: list, criteria_list: list):
+    if not question:
+        return "Missing question"
+    if len(options_list) < 2:
+        return "Add at least 2 options"
+    if len(criteria_list) < 1:
+        return "Add at least 1 criterion"
+    return None
+
+
+def clean_question(question) -> str:
+    if question is None:
+        return ""
+    if not isinstance(question, str):
+        raise TypeError("question must be a string")
+    return question.strip()
+
+
+def clean_options(options_list: list) -> list[str]:
+    if not isinstance(options_list, list):
+        raise TypeError("options must be a list")
+    out = []
+    for opt in options_list:
+        name = (str(opt) or "").strip()
+        if name:
+            out.append(name)
+    return out
+
+
+def clean_criteria(criteria_list: list) -> list[dict]:
+    if not isinstance(criteria_list, list):
+        raise TypeError("criteria must be a list")
+    out = []
+    for c in criteria_list:
+        if isinstance(c, dict):
+            name = c.get("name") or ""
+            if not isinstance(name, str):
+                raise TypeError("criterion name must be a string")
+            name = name.strip()
+            importance = int(c.get("importance") or 3)
+        else:
+            name = (str(c) or "").strip()
+            importance = 3
+
+        if not name:
+            continue
+        out.append({"name": name, "importance": max(1, min(5, importance))})
+    return out
+
+
+def retrieve_kb_for(decision_type: str, question: str):
+    retrieved_docs = retrieve(KB_DOCS, decision_type, question, top_k=3)
+    kb_used = [{
+        "path": d.get("path", ""),
+        "title": d.get("title", ""),
+        "category": d.get("category", "")
+    } for d in retrieved_docs]
+
+    print("KB RETRIEVED:", [d.get("path") for d in retrieved_docs])
+
+    scoring_docs = pick_scoring_docs(retrieved_docs, question, max_docs=2)
+    print("SCORING DOCS:", [d.get("path") for d in scoring_docs])
+
+    return kb_used, scoring_docs
+
+
+def extracted_decision_type(extracted: dict, question: str) -> str:
+    return (extracted.get("decision_type") or guess_decision_type(question)).strip().lower()
+
+
+def prepare_decision(question: str) -> dict:
+    extracted, extract_tier = extract_decision_details(question)
+    decision_type = extracted_decision_type(extracted, question)
+
+    print("EXTRACTED RESULT:", extracted)
+    print("DECISION TYPE:", decision_type)
+
+    kb_used, scoring_docs = retrieve_kb_for(decision_type, question)
+    return {
+        "extracted": extracted,
+        "extract_tier": extract_tier,
+        "decision_type": decision_type,
+        "kb_used": kb_used,
+        "scoring_docs": scoring_docs
+    }
+
+
+def score_decision(question: str, opt_names: list[str], crit_names: list[str], scoring_docs: list[dict], kb_context: str | None = None) -> tuple[list[dict], dict]:
+    cells = len(opt_names) * len(crit_names)
+    ladder = tier_ladder("matrix", cells)
+
+    # keep the attempt with the most usable cells: a larger model is not guaranteed to do better
+    best = None
+    for tier in ladder:
+        # escalation is the retry for every tier but the last, as in extraction
+        llm_out = llm_fill_matrix(
+            question, opt_names, crit_names, scoring_docs, kb_context=kb_context,
+            model=OLLAMA_MODELS[tier], retries=MATRIX_RETRIES if tier == ladder[-1] else 0
+        )
+        valid = count_valid_cells(llm_out, opt_names, crit_names)
+        if best is None or valid >= best[1]:
+            best = (tier, valid, llm_out)
+        if not cells or (cells - valid) / cells <= MATRIX_MAX_DEFAULTED_RATIO:
+            break
+        print(f"MATRIX ESCALATING from {tier}: {cells - valid}/{cells} cells would default")
+
+    tier, valid, llm_out = best
+    tier_info = {"tier": tier, "model": OLLAMA_MODELS[tier], "defaulted_cells": cells - valid, "prompt_version": MATRIX_PROMPT_VERSION}
+
+    if cells and not valid:
+        # no tier produced a single usable cell: keyword scores beat a matrix of padded 3s
+        matrix = keyword_fallback_scores(question, opt_names, crit_names)
+        tier_info.update({"tier": "fallback", "model": None})
+    else:
+        matrix = validate_matrix(llm_out, opt_names, crit_names)
+    return matrix, tier_info
+
+
+def insert_decision(cur, user_id: int, question: str, extracted: dict, kb_used: list[dict], opt_names: list[str], criteria: list[dict], llm_tiers: dict) -> int:
+    cur.execute(
+        "INSERT INTO decisions (user_id, question, extracted_context_json, kb_used_json, llm_tiers_json) VALUES (?, ?, ?, ?, ?)",
+        (user_id, question, json.dumps(extracted, ensure_ascii=False), json.dumps(kb_used, ensure_ascii=False), json.dumps(llm_tiers))
+    )
+    decision_id = cur.lastrowid
+
+    cur.executemany(
+        "INSERT INTO options (decision_id, name, source) VALUES (?, ?, ?)",
+        [(decision_id, name, "manual") for name in opt_names]
+    )
+    cur.executemany(
+        "INSERT INTO criteria (decision_id, name, importance) VALUES (?, ?, ?)",
+        [(decision_id, c["name"], c["importance"]) for c in criteria]
+    )
+    return decision_id
+
+
+def save_matrix(cur, decision_id: int, matrix: list[dict]):
+    options_rows = cur.execute(
+        "SELECT id, name FROM options WHERE decision_id = ?",
+        (decision_id,)
+    ).fetchall()
+    name_to_id = {_norm(r["name"]): r["id"] for r in options_rows}
+
+    score_rows = []
+    reason_rows = []
+    for mrow in matrix:
+        oid = name_to_id.get(_norm(mrow["option"]))
+        if not oid:
+            continue
+        score_rows.append((oid, mrow["criterion"], mrow["score"]))
+        reason_rows.append((oid, mrow["criterion"], mrow["reason"]))
+
+    cur.executemany(
+        """INSERT INTO option_scores (option_id, criterion, score)
+           VALUES (?, ?, ?)
+           ON CONFLICT(option_id, criterion) DO UPDATE SET score=excluded.score""",
+        score_rows
+    )
+    cur.executemany(
+        """INSERT INTO option_score_reasons (option_id, criterion, reason)
+           VALUES (?, ?, ?)
+           ON CONFLICT(option_id, criterion) DO UPDATE SET reason=excluded.reason""",
+        reason_rows
+    )
+
+
+def kb_docs_from_used(kb_used: list[dict]) -> list[dict]:
+    by_path = {d.get("path", ""): d for d in KB_DOCS}
+    return [by_path[k["path"]] for k in kb_used if k.get("path") in by_path]
+
+
+#speculative preparation while the user is still adding options/criteria
+
+
+PREPARE_POOL = ThreadPoolExecutor(max_workers=2)
+PREPARED = {}
+PREPARED_LOCK = threading.Lock()
+
+
+def _purge_prepared(now: float):
+    for token in [t for t, e in PREPARED.items() if now - e["created"] > PREPARE_TTL]:
+        PREPARED.pop(token)["future"].cancel()
+
+
+def start_prepare(user_id: int, question: str) -> str:
+    qkey = _norm(question)
+    now = time.time()
+
+    with PREPARED_LOCK:
+        _purge_prepared(now)
+
+        # one live prepare per user: a new question supersedes older ones, including
+        # entries whose request was aborted before the client ever saw the token
+        for token in [t for t, e in PREPARED.items() if e["user_id"] == user_id and e["qkey"] != qkey]:
+            PREPARED.pop(token)["future"].cancel()
+
+        for token, e in PREPARED.items():
+            if e["user_id"] == user_id and e["qkey"] == qkey:
+                return token
+
+        token = secrets.token_urlsafe(16)
+        PREPARED[token] = {
+            "user_id": user_id,
+            "qkey": qkey,
+            "created": now,
+            "future": PREPARE_POOL.submit(run_as_llm_caller, user_id, PRIORITY_BACKGROUND, prepare_decision, question)
+        }
+        return token
+
+
+def take_prepared(user_id: int, question: str, token: str | None):
+    if not token:
+        return None
+
+    with PREPARED_LOCK:
+        e = PREPARED.pop(token, None)
+
+    if not e or e["user_id"] != user_id or e["qkey"] != _norm(question):
+        return None
+    if time.time() - e["created"] > PREPARE_TTL or e["future"].cancelled():
+        return None
+    # still queued behind other users' prepares: extracting inline is faster than waiting for a pool thread
+    if not e["future"].running() and e["future"].cancel():
+        return None
+
+    try:
+        return e["future"].result(timeout=PREPARE_WAIT_TIMEOUT)
+    except Exception as ex:
+        print("PREPARE ERROR:", ex)
+        return None
+
+
+#response cache for scored decisions (keyed by decision version, bumped on every edit)
+
+
+RESULT_CACHE = OrderedDict()
+RESULT_CACHE_LOCK = threading.Lock()
+
+
+def response_build_id() -> str:
+    # part of every result ETag, so a deploy that changes the app or its templates
+    # never answers 304 with HTML rendered by the previous build
+    if os.environ.get("APP_BUILD_ID"):
+        return os.environ["APP_BUILD_ID"]
+
+    h = hashlib.sha1()
+    paths = [os.path.abspath(__file__)]
+    for sub in ("templates", "static"):
+        root = os.path.join(BASE_DIR, sub)
+        for dirpath, _, files in sorted(os.walk(root)):
+            paths += [os.path.join(dirpath, f) for f in sorted(files)]
+    for path in paths:
+        h.update(os.path.relpath(path, BASE_DIR).encode("utf-8"))
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()[:12]
+
+
+RESPONSE_BUILD_ID = response_build_id()
+
+
+def invalidate_decision_cache(decision_id: int):
+    with RESULT_CACHE_LOCK:
+        for key in [k for k in RESULT_CACHE if k[0] == decision_id]:
+            del RESULT_CACHE[key]
+
+
+def cached_decision_response(decision_id: int, kind: str, mimetype: str, build):
+    conn = get_db()
+    row = conn.execute(
+        "SELECT version FROM decisions WHERE id = ? AND user_id = ?",
+        (decision_id, session["user_id"])
+    ).fetchone()
+
+    if not row:
+        conn.close()
+        return "Not found", 404
+
+    version = row["version"] or 1
+    etag = f"d{decision_id}-v{version}-{kind}-{RESPONSE_BUILD_ID}"
+
+    if request.if_none_match.contains(etag):
+        conn.close()
+        resp = Response(status=304)
+    else:
+        key = (decision_id, version, kind)
+        with RESULT_CACHE_LOCK:
+            body = RESULT_CACHE.get(key)
+            if body is not None:
+                RESULT_CACHE.move_to_end(key)
+
+        if body is None:
+            body = build(conn, decision_id)
+            with RESULT_CACHE_LOCK:
+                RESULT_CACHE[key] = body
+                while len(RESULT_CACHE) > RESULT_CACHE_SIZE:
+                    RESULT_CACHE.popitem(last=False)
+        conn.close()
+        resp = Response(body, mimetype=mimetype)
+
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+
+#cross-decision analytics, maintained incrementally in the same transaction as each write
+
+
+ANALYTICS_TABLES = ["analytics_criteria_by_type", "analytics_role_criterion_scores", "analytics_llm_outcomes"]
+
+
+def criterion_key(name: str) -> str:
+    return _norm((name or "").replace("_", " "))
+
+
+def build_role_patterns() -> list[str]:
+    roles = set()
+    for f in KB_FEATURES.values():
+        for header in ("option role patterns", "option roles"):
+            for item in f["sections"].get(header, []):
+                key = criterion_key(re.sub(r"\(.*?\)", "", item))
+                if key:
+                    roles.add(key)
+    # longest first so "higher studies" wins over a shorter overlapping role
+    return sorted(roles, key=len, reverse=True)
+
+
+ROLE_PATTERNS = build_role_patterns()
+
+
+def option_role(option_name: str) -> str:
+    padded = f" {criterion_key(option_name)} "
+    for role in ROLE_PATTERNS:
+        if f" {role} " in padded:
+            return role
+    return "other"
+
+
+def decision_analytics_snapshot(cur, decision_id: int) -> dict:
+    row = cur.execute("SELECT extracted_context_json FROM decisions WHERE id = ?", (decision_id,)).fetchone()
+    extracted = json.loads((row["extracted_context_json"] if row else None) or "{}")
+
+    criteria = cur.execute(
+        "SELECT name, importance FROM criteria WHERE decision_id = ?",
+        (decision_id,)
+    ).fetchall()
+    cells = cur.execute(
+        """SELECT o.name as option_name, os.criterion, os.score
+           FROM option_scores os
+           JOIN options o ON o.id = os.option_id
+           WHERE o.decision_id = ?""",
+        (decision_id,)
+    ).fetchall()
+
+    return {
+        "decision_type": (extracted.get("decision_type") or "other").strip().lower(),
+        "criteria": [(c["name"], int(c["importance"] or 3)) for c in criteria],
+        "cells": [(r["option_name"], r["criterion"], int(r["score"])) for r in cells]
+    }
+
+
+def apply_decision_analytics(cur, snap: dict, sign: int = 1):
+    cur.executemany(
+        """INSERT INTO analytics_criteria_by_type (decision_type, criterion_key, uses, importance_sum)
+           VALUES (?, ?, ?, ?)
+           ON CONFLICT(decision_type, criterion_key) DO UPDATE SET
+               uses = uses + excluded.uses,
+               importance_sum = importance_sum + excluded.importance_sum""",
+        [(snap["decision_type"], criterion_key(name), sign, sign * importance) for name, importance in snap["criteria"]]
+    )
+
+    by_role = {}
+    for option_name, criterion, score in snap["cells"]:
+        k = (option_role(option_name), criterion_key(criterion))
+        n, total = by_role.get(k, (0, 0))
+        by_role[k] = (n + 1, total + score)
+
+    cur.executemany(
+        """INSERT INTO analytics_role_criterion_scores (role_pattern, criterion_key, n, score_sum)
+           VALUES (?, ?, ?, ?)
+           ON CONFLICT(role_pattern, criterion_key) DO UPDATE SET
+               n = n + excluded.n,
+               score_sum = score_sum + excluded.score_sum""",
+        [(role, ck, sign * n, sign * total) for (role, ck), (n, total) in by_role.items()]
+    )
+
+
+def record_llm_outcomes(cur, llm_tiers: dict):
+    rows = []
+    for stage, info in (llm_tiers or {}).items():
+        for i in (info if isinstance(info, list) else [info]):
+            rows.append((stage, i.get("tier") or "unknown", int(i.get("defaulted_cells") or 0)))
+
+    cur.executemany(
+        """INSERT INTO analytics_llm_outcomes (stage, tier, calls, defaulted_cells)
+           VALUES (?, ?, 1, ?)
+           ON CONFLICT(stage, tier) DO UPDATE SET
+               calls = calls + 1,
+               defaulted_cells = defaulted_cells + excluded.defaulted_cells""",
+        rows
+    )
+
+
+def rebuild_analytics(conn):
+    cur = conn.cursor()
+    for table in ANALYTICS_TABLES:
+        cur.execute(f"DELETE FROM {table}")
+
+    for d in cur.execute("SELECT id, llm_tiers_json FROM decisions").fetchall():
+        apply_decision_analytics(cur, decision_analytics_snapshot(cur, d["id"]))
+        record_llm_outcomes(cur, json.loads(d["llm_tiers_json"] or "{}"))
+
+    conn.commit()
+
+
+#batch evaluation (JSONL / CSV)
+
+
+def parse_batch_items(raw: str, fmt: str) -> list[dict]:
+    items = []
+    if fmt == "csv":
+        # columns: question, options ("A|B|C"), criteria ("Salary:5|Growth:4|Commute")
+        for row in csv.DictReader(io.StringIO(raw)):
+            criteria = []
+            for part in (row.get("criteria") or "").split("|"):
+                name, _, importance = part.partition(":")
+                criteria.append({"name": name.strip(), "importance": importance.strip() or 3})
+            items.append({
+                "question": row.get("question") or "",
+                "options": [o for o in (row.get("options") or "").split("|")],
+                "criteria": criteria
+            })
+        return items
+
+    for line in raw.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except Exception:
+            item = None
+        items.append(item if isinstance(item, dict) else {"_error": "Invalid JSON line"})
+    return items
+
+
+def flush_batch(user_id: int, done_items: list[dict]) -> list[dict]:
+    conn = get_db()
+    cur = conn.cursor()
+    results = []
+
+    for it in done_items:
+        decision_id = insert_decision(cur, user_id, it["question"], it["extracted"], it["kb_used"], it["options"], it["criteria"], it["llm_tiers"])
+        save_matrix(cur, decision_id, it["matrix"])
+        apply_decision_analytics(cur, decision_analytics_snapshot(cur, decision_id))
+        record_llm_outcomes(cur, it["llm_tiers"])
+        results.append({
+            "index": it["index"],
+            "ok": True,
+            "status": "saved",
+            "decision_id": decision_id,
+            "result_url": f"/decision/{decision_id}/result"
+        })
+
+    conn.commit()
+    conn.close()
+    return results
+
+
+def run_decision_batch(user_id: int, items: list[dict]):
+    valid = []
+    for idx, item in enumerate(items):
+        if item.get("_error"):
+            yield {"index": idx, "ok": False, "error": item["_error"]}
+            continue
+
+        try:
+            question = clean_question(item.get("question"))
+            opt_names = clean_options(item.get("options") or [])
+            criteria = clean_criteria(item.get("criteria") or [])
+        except (TypeError, ValueError):
+            yield {"index": idx, "ok": False, "error": "Invalid question, options or criteria"}
+            continue
+
+        err = check_decision_input(question, opt_names, criteria)
+        if err:
+            yield {"index": idx, "ok": False, "error": err}
+            continue
+
+        valid.append({"index": idx, "question": question, "options": opt_names, "criteria": criteria})
+
+    # one extraction per distinct question, and one KB retrieval/context build per extracted decision
+    # type, shared by every item of that type. scoring starts for a question as soon as its extraction
+    # lands, so both stages overlap in the pool. each item streams a "scored" line the moment its matrix
+    # is ready and a "saved" line once the commit batch holding it is written
+    by_question = {}
+    for it in valid:
+        by_question.setdefault(_norm(it["question"]), []).append(it)
+
+    kb_by_type = {}
+    pending = []
+    pool = ThreadPoolExecutor(max_workers=LLM_SLOTS)
+    try:
+        running = {
+            pool.submit(run_as_llm_caller, user_id, PRIORITY_BATCH, extract_decision_details, group[0]["question"]): ("extract", key)
+            for key, group in by_question.items()
+        }
+
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                kind, ref = running.pop(fut)
+
+                if kind == "extract":
+                    group = by_question[ref]
+                    try:
+                        extracted, extract_tier = fut.result()
+                        decision_type = extracted_decision_type(extracted, group[0]["question"])
+                        if decision_type not in kb_by_type:
+                            kb_used, scoring_docs = retrieve_kb_for(decision_type, group[0]["question"])
+                            kb_by_type[decision_type] = (kb_used, scoring_docs, build_kb_context(scoring_docs))
+                        kb_used, scoring_docs, kb_context = kb_by_type[decision_type]
+                    except Exception as e:
+                        print("BATCH ERROR (extract):", e)
+                        for it in group:
+                            yield {"index": it["index"], "ok": False, "error": "Extraction failed"}
+                        continue
+
+                    for it in group:
+                        it.update({"extracted": extracted, "decision_type": decision_type, "kb_used": kb_used})
+                        it["llm_tiers"] = {"extract": extract_tier}
+                        crit_names = [c["name"] for c in it["criteria"]]
+                        f = pool.submit(
+                            run_as_llm_caller, user_id, PRIORITY_BATCH,
+                            score_decision, it["question"], it["options"], crit_names, scoring_docs, kb_context
+                        )
+                        running[f] = ("score", it)
+                    continue
+
+                try:
+                    ref["matrix"], ref["llm_tiers"]["matrix"] = fut.result()
+                except Exception as e:
+                    print("BATCH ERROR (matrix):", e)
+                    yield {"index": ref["index"], "ok": False, "error": "Scoring failed"}
+                    continue
+                pending.append(ref)
+
+                names = {_norm(n): n for n in ref["options"] + [c["name"] for c in ref["criteria"]]}
+                yield {
+                    "index": ref["index"],
+                    "ok": True,
+                    "status": "scored",
+                    "decision_type": ref["decision_type"],
+                    "ranking": compute_ranking(
+                        [{"name": o} for o in ref["options"]],
+                        ref["criteria"],
+                        [{"option_name": names.get(_norm(m["option"]), m["option"]), "criterion": names.get(_norm(m["criterion"]), m["criterion"]), "score": m["score"]} for m in ref["matrix"]]
+                    )
+                }
+
+            if len(pending) >= BATCH_COMMIT_SIZE:
+                batch, pending = pending, []
+                yield from flush_batch(user_id, batch)
+    except GeneratorExit:
+        # client went away: drop queued LLM work and keep whatever already finished
+        pool.shutdown(wait=False, cancel_futures=True)
+        if pending:
+            flush_batch(user_id, pending)
+        raise
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    if pending:
+        yield from flush_batch(user_id, pending)
+
+
 def get_db():
     conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
@@ -418,11 +1174,20 @@ def init_db():
         question TEXT NOT NULL,
         extracted_context_json TEXT,
         kb_used_json TEXT,
+        version INTEGER DEFAULT 1,
+        llm_tiers_json TEXT,
         created_at TEXT DEFAULT CURRENT_TIMESTAMP,
         FOREIGN KEY(user_id) REFERENCES users(id)
     )
     """)
 
+    # older app.db files predate these columns
+    decision_cols = {r["name"] for r in cur.execute("PRAGMA table_info(decisions)").fetchall()}
+    if "version" not in decision_cols:
+        cur.execute("ALTER TABLE decisions ADD COLUMN version INTEGER DEFAULT 1")
+    if "llm_tiers_json" not in decision_cols:
+        cur.execute("ALTER TABLE decisions ADD COLUMN llm_tiers_json TEXT")
+
     cur.execute("""
     CREATE TABLE IF NOT EXISTS options (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -465,9 +1230,73 @@ def init_db():
     )
     """)
 
+    existing_tables = {r["name"] for r in cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()}
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS analytics_criteria_by_type (
+        decision_type TEXT NOT NULL,
+        criterion_key TEXT NOT NULL,
+        uses INTEGER NOT NULL DEFAULT 0,
+        importance_sum INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(decision_type, criterion_key)
+    )
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS analytics_role_criterion_scores (
+        role_pattern TEXT NOT NULL,
+        criterion_key TEXT NOT NULL,
+        n INTEGER NOT NULL DEFAULT 0,
+        score_sum INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(role_pattern, criterion_key)
+    )
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS analytics_llm_outcomes (
+        stage TEXT NOT NULL,
+        tier TEXT NOT NULL,
+        calls INTEGER NOT NULL DEFAULT 0,
+        defaulted_cells INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(stage, tier)
+    )
+    """)
+
     conn.commit()
+
+    # a database from before the aggregates existed gets them filled once from its decisions,
+    # otherwise the first PATCH of an old decision would subtract counts that were never added
+    if not set(ANALYTICS_TABLES) <= existing_tables:
+        rebuild_analytics(conn)
     conn.close()
 
+#static assets: fingerprinted with the file mtime so they can be cached for a year
+
+
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = STATIC_MAX_AGE
+
+
+@app.url_defaults
+def static_cache_buster(endpoint, values):
+    if endpoint == "static" and "filename" in values and "v" not in values:
+        path = os.path.join(app.static_folder, values["filename"])
+        if os.path.isfile(path):
+            values["v"] = int(os.path.getmtime(path))
+
+
+@app.before_request
+def mark_interactive_llm_caller():
+    LLM_CALLER.set((session.get("user_id"), PRIORITY_INTERACTIVE))
+
+
+@app.errorhandler(LLMOverloaded)
+def llm_overloaded(e):
+    resp = jsonify({"ok": False, "error": "The model is busy, please retry shortly", "retry_after": e.retry_after})
+    resp.status_code = 429
+    resp.headers["Retry-After"] = str(e.retry_after)
+    return resp
+
+
 #login route
 
 
@@ -480,6 +1309,22 @@ def login_required(fn):
     return wrapper
 
 
+def admin_required(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if "user_id" not in session:
+            return redirect(url_for("login"))
+
+        conn = get_db()
+        user = conn.execute("SELECT email FROM users WHERE id = ?", (session["user_id"],)).fetchone()
+        conn.close()
+
+        if not user or user["email"] not in ADMIN_EMAILS:
+            return "Forbidden", 403
+        return fn(*args, **kwargs)
+    return wrapper
+
+
 @app.route("/")
 def home():
     return render_template("index.html")
@@ -633,132 +1478,111 @@ def decision():
 def decision_submit():
     data = request.get_json(silent=True) or {}
 
-    question = (data.get("question") or "").strip()
-    options_list = data.get("options") or []
-    criteria_list = data.get("criteria") or []
-
-    if not question:
-        return {"ok": False, "error": "Missing question"}, 400
-    if len(options_list) < 2:
-        return {"ok": False, "error": "Add at least 2 options"}, 400
-    if len(criteria_list) < 1:
-        return {"ok": False, "error": "Add at least 1 criterion"}, 400
-
-    extracted = extract_decision_details(question)
-    decision_type = (extracted.get("decision_type") or guess_decision_type(question)).strip().lower()
-
-    print("EXTRACTED RESULT:", extracted)
-    print("DECISION TYPE:", decision_type)
-
-    retrieved_docs = retrieve(KB_DOCS, decision_type, question, top_k=3)
-    kb_used = [{
-        "path": d.get("path", ""),
-        "title": d.get("title", ""),
-        "category": d.get("category", "")
-    } for d in retrieved_docs]
-    kb_used_json = json.dumps(kb_used, ensure_ascii=False)
-
-    print("KB RETRIEVED:", [d.get("path") for d in retrieved_docs])
-
-    scoring_docs = pick_scoring_docs(retrieved_docs, question, max_docs=2)
-    print("SCORING DOCS:", [d.get("path") for d in scoring_docs])
+    try:
+        question = clean_question(data.get("question"))
+        opt_names = clean_options(data.get("options") or [])
+        criteria = clean_criteria(data.get("criteria") or [])
+    except (TypeError, ValueError):
+        return {"ok": False, "error": "Invalid question, options or criteria"}, 400
+
+    err = check_decision_input(question, opt_names, criteria)
+    if err:
+        return {"ok": False, "error": err}, 400
+    crit_names = [c["name"] for c in criteria]
+
+    prepared = take_prepared(session["user_id"], question, data.get("prepare_token"))
+    if prepared is None:
+        prepared = prepare_decision(question)
+
+    extracted = prepared["extracted"]
+    kb_used = prepared["kb_used"]
+    matrix, matrix_tier = score_decision(question, opt_names, crit_names, prepared["scoring_docs"])
+    llm_tiers = {"extract": prepared["extract_tier"], "matrix": matrix_tier}
 
     conn = get_db()
     cur = conn.cursor()
 
-    cur.execute(
-        "INSERT INTO decisions (user_id, question, extracted_context_json, kb_used_json) VALUES (?, ?, ?, ?)",
-        (session["user_id"], question, json.dumps(extracted, ensure_ascii=False), kb_used_json)
-    )
-    decision_id = cur.lastrowid
+    decision_id = insert_decision(cur, session["user_id"], question, extracted, kb_used, opt_names, criteria, llm_tiers)
+    save_matrix(cur, decision_id, matrix)
+    apply_decision_analytics(cur, decision_analytics_snapshot(cur, decision_id))
+    record_llm_outcomes(cur, llm_tiers)
 
-    for opt in options_list:
-        name = (str(opt) or "").strip()
-        if not name:
-            continue
-        cur.execute(
-            "INSERT INTO options (decision_id, name, source) VALUES (?, ?, ?)",
-            (decision_id, name, "manual")
-        )
+    conn.commit()
+    conn.close()
 
-    for c in criteria_list:
-        if isinstance(c, dict):
-            name = (c.get("name") or "").strip()
-            importance = int(c.get("importance") or 3)
-        else:
-            name = (str(c) or "").strip()
-            importance = 3
+    # return also the URL so the frontend can redirect
+    return {"ok": True, "decision_id": decision_id, "kb_used": kb_used, "result_url": f"/decision/{decision_id}/result"}
 
-        if not name:
-            continue
-        importance = max(1, min(5, importance))
 
-        cur.execute(
-            "INSERT INTO criteria (decision_id, name, importance) VALUES (?, ?, ?)",
-            (decision_id, name, importance)
-        )
+@app.route("/decision/suggest", methods=["GET"])
+@login_required
+def decision_suggest():
+    kind = (request.args.get("kind") or "criteria").strip().lower()
+    if kind not in ("option", "criteria"):
+        return {"ok": False, "error": "kind must be option or criteria"}, 400
 
-    options_rows = conn.execute(
-        "SELECT id, name FROM options WHERE decision_id = ?",
-        (decision_id,)
-    ).fetchall()
+    question = request.args.get("question") or ""
+    decision_type = (request.args.get("decision_type") or guess_decision_type(question)).strip().lower()
+    limit = max(1, min(20, request.args.get("limit", 8, type=int)))
 
-    criteria_rows = conn.execute(
-        "SELECT name, importance FROM criteria WHERE decision_id = ?",
-        (decision_id,)
-    ).fetchall()
+    suggestions = SUGGEST_INDEX.lookup(kind, request.args.get("q") or "", decision_type, question, limit)
+    return {"ok": True, "decision_type": decision_type, "suggestions": suggestions}
 
-    opt_names = [r["name"] for r in options_rows]
-    crit_names = [r["name"] for r in criteria_rows]
 
-    llm_out = llm_fill_matrix(question, opt_names, crit_names, scoring_docs)
-    matrix = validate_matrix(llm_out, opt_names, crit_names)
+@app.route("/decision/prepare", methods=["POST"])
+@login_required
+def decision_prepare():
+    data = request.get_json(silent=True) or {}
 
-    if not matrix:
-        matrix = keyword_fallback_scores(question, opt_names, crit_names)
+    try:
+        question = clean_question(data.get("question"))
+    except TypeError:
+        return {"ok": False, "error": "Invalid question"}, 400
+    if not question:
+        return {"ok": False, "error": "Missing question"}, 400
 
-    name_to_id = {_norm(r["name"]): r["id"] for r in options_rows}
+    token = start_prepare(session["user_id"], question)
+    return {"ok": True, "prepare_token": token}
 
-    for mrow in matrix:
-        oid = name_to_id.get(_norm(mrow["option"]))
-        if not oid:
-            continue
 
-        cur.execute(
-            """INSERT INTO option_scores (option_id, criterion, score)
-               VALUES (?, ?, ?)
-               ON CONFLICT(option_id, criterion) DO UPDATE SET score=excluded.score""",
-            (oid, mrow["criterion"], mrow["score"])
-        )
+@app.route("/llm/metrics", methods=["GET"])
+@admin_required
+def llm_metrics():
+    m = LLM_SCHEDULER.metrics()
+    m["prefill"] = prefill_metrics()
+    return jsonify(m)
 
-        cur.execute(
-            """INSERT INTO option_score_reasons (option_id, criterion, reason)
-               VALUES (?, ?, ?)
-               ON CONFLICT(option_id, criterion) DO UPDATE SET reason=excluded.reason""",
-            (oid, mrow["criterion"], mrow["reason"])
-        )
 
-    conn.commit()
-    conn.close()
+@app.route("/decision/batch", methods=["POST"])
+@login_required
+def decision_batch():
+    fmt = (request.args.get("format") or "").strip().lower()
+    if not fmt:
+        fmt = "csv" if "csv" in (request.mimetype or "") else "jsonl"
+    if fmt not in ("csv", "jsonl"):
+        return {"ok": False, "error": "format must be csv or jsonl"}, 400
 
-    # return also the URL so the frontend can redirect
-    return {"ok": True, "decision_id": decision_id, "kb_used": kb_used, "result_url": f"/decision/{decision_id}/result"}
+    items = parse_batch_items(request.get_data(as_text=True), fmt)
+    if not items:
+        return {"ok": False, "error": "No decisions in batch"}, 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return {"ok": False, "error": f"At most {BATCH_MAX_ITEMS} decisions per batch"}, 400
 
+    user_id = session["user_id"]
 
-@app.route("/decision/<int:decision_id>/debug", methods=["GET"])
-@login_required
-def decision_debug(decision_id):
-    conn = get_db()
+    def stream():
+        for res in run_decision_batch(user_id, items):
+            yield json.dumps(res, ensure_ascii=False) + "\n"
 
+    return Response(stream_with_context(stream()), mimetype="application/x-ndjson")
+
+
+def build_decision_debug(conn, decision_id: int) -> str:
     row = conn.execute(
-        "SELECT question, extracted_context_json, kb_used_json FROM decisions WHERE id = ? AND user_id = ?",
-        (decision_id, session["user_id"])
+        "SELECT question, extracted_context_json, kb_used_json, llm_tiers_json FROM decisions WHERE id = ?",
+        (decision_id,)
     ).fetchone()
 
-    if not row:
-        conn.close()
-        return "Not found", 404
-
     opts = conn.execute(
         "SELECT id, name FROM options WHERE decision_id = ? ORDER BY id",
         (decision_id,)
@@ -787,8 +1611,6 @@ def decision_debug(decision_id):
         (decision_id,)
     ).fetchall()
 
-    conn.close()
-
     options_list = [{"id": o["id"], "name": o["name"]} for o in opts]
     criteria_list = [{"name": c["name"], "importance": c["importance"]} for c in crit]
     score_list = [{"option_name": s["option_name"], "criterion": s["criterion"], "score": s["score"]} for s in scores]
@@ -799,6 +1621,7 @@ def decision_debug(decision_id):
         "question": row["question"],
         "extracted": json.loads(row["extracted_context_json"] or "{}"),
         "kb_used": json.loads(row["kb_used_json"] or "[]"),
+        "llm_tiers": json.loads(row["llm_tiers_json"] or "{}"),
         "options": [o["name"] for o in opts],
         "criteria": [{"name": c["name"], "importance": c["importance"]} for c in crit],
         "option_scores": [
@@ -810,25 +1633,17 @@ def decision_debug(decision_id):
             for r in reasons
         ],
         "ranking": ranking
-    })
+    }).get_data(as_text=True)
 
 
 #  NEW RESULT PAGE ROUTE
 
-@app.route("/decision/<int:decision_id>/result", methods=["GET"])
-@login_required
-def decision_result(decision_id):
-    conn = get_db()
-
+def render_decision_result(conn, decision_id: int) -> str:
     d = conn.execute(
-        "SELECT id, question, created_at, kb_used_json FROM decisions WHERE id=? AND user_id=?",
-        (decision_id, session["user_id"])
+        "SELECT id, question, created_at, kb_used_json FROM decisions WHERE id=?",
+        (decision_id,)
     ).fetchone()
 
-    if not d:
-        conn.close()
-        return "Not found", 404
-
     opts = conn.execute(
         "SELECT id, name FROM options WHERE decision_id=? ORDER BY id",
         (decision_id,)
@@ -857,8 +1672,6 @@ def decision_result(decision_id):
         (decision_id,)
     ).fetchall()
 
-    conn.close()
-
     options_list = [{"id": o["id"], "name": o["name"]} for o in opts]
     criteria_list = [{"name": c["name"], "importance": c["importance"]} for c in crit]
     score_list = [{"option_name": s["option_name"], "criterion": s["criterion"], "score": s["score"]} for s in scores]
@@ -912,6 +1725,279 @@ def decision_result(decision_id):
     return render_template("result.html", decision=decision, ranked=ranked)
 
 
+@app.route("/decision/<int:decision_id>/debug", methods=["GET"])
+@login_required
+def decision_debug(decision_id):
+    return cached_decision_response(decision_id, "debug", "application/json", build_decision_debug)
+
+
+@app.route("/decision/<int:decision_id>/result", methods=["GET"])
+@login_required
+def decision_result(decision_id):
+    return cached_decision_response(decision_id, "result", "text/html", render_decision_result)
+
+
+@app.route("/decision/<int:decision_id>", methods=["PATCH"])
+@login_required
+def decision_patch(decision_id):
+    data = request.get_json(silent=True) or {}
+
+    conn = get_db()
+    cur = conn.cursor()
+
+    d = cur.execute(
+        "SELECT question, kb_used_json, llm_tiers_json FROM decisions WHERE id = ? AND user_id = ?",
+        (decision_id, session["user_id"])
+    ).fetchone()
+
+    if not d:
+        conn.close()
+        return {"ok": False, "error": "Not found"}, 404
+
+    opts = cur.execute("SELECT id, name FROM options WHERE decision_id = ? ORDER BY id", (decision_id,)).fetchall()
+    crit = cur.execute("SELECT id, name, importance FROM criteria WHERE decision_id = ? ORDER BY id", (decision_id,)).fetchall()
+
+    try:
+        add_opts = clean_options(data.get("add_options") or [])
+        add_crit = clean_criteria(data.get("add_criteria") or [])
+        importances = {_norm(k): max(1, min(5, int(v))) for k, v in (data.get("importance") or {}).items()}
+    except (TypeError, ValueError, AttributeError):
+        conn.close()
+        return {"ok": False, "error": "Invalid patch"}, 400
+
+    if not isinstance(data.get("remove_options") or [], list) or not isinstance(data.get("remove_criteria") or [], list):
+        conn.close()
+        return {"ok": False, "error": "remove_options and remove_criteria must be lists"}, 400
+
+    remove_opts = {_norm(str(o)) for o in (data.get("remove_options") or [])}
+    remove_crit = {_norm(str(c)) for c in (data.get("remove_criteria") or [])}
+
+    kept_opts = [o["name"] for o in opts if _norm(o["name"]) not in remove_opts]
+    kept_crit = [c["name"] for c in crit if _norm(c["name"]) not in remove_crit]
+
+    seen = {_norm(n) for n in kept_opts}
+    new_opts = []
+    for name in add_opts:
+        if _norm(name) not in seen:
+            seen.add(_norm(name))
+            new_opts.append(name)
+
+    seen = {_norm(n) for n in kept_crit}
+    new_crit = []
+    for c in add_crit:
+        if _norm(c["name"]) not in seen:
+            seen.add(_norm(c["name"]))
+            new_crit.append(c)
+
+    err = check_decision_input(d["question"], kept_opts + new_opts, kept_crit + new_crit)
+    if err:
+        conn.close()
+        return {"ok": False, "error": err}, 400
+
+    # only the cells that did not exist before go to the LLM:
+    # new options x every criterion, plus existing options x new criteria
+    new_crit_names = [c["name"] for c in new_crit]
+    matrix = []
+    patch_tiers = []
+    if new_opts or new_crit:
+        kb_used = json.loads(d["kb_used_json"] or "[]")
+        scoring_docs = pick_scoring_docs(kb_docs_from_used(kb_used), d["question"], max_docs=2)
+        kb_context = build_kb_context(scoring_docs)
+
+        blocks = []
+        if new_opts:
+            blocks.append((new_opts, kept_crit + new_crit_names))
+        if kept_opts and new_crit_names:
+            blocks.append((kept_opts, new_crit_names))
+
+        for block_opts, block_crit in blocks:
+            block, tier = score_decision(d["question"], block_opts, block_crit, scoring_docs, kb_context)
+            matrix += block
+            patch_tiers.append(tier)
+
+    # another PATCH may have committed while the LLM was scoring: take the write lock,
+    # then re-check the additions and removals against the rows as they are now
+    cur.execute("BEGIN IMMEDIATE")
+    llm_tiers = json.loads(cur.execute("SELECT llm_tiers_json FROM decisions WHERE id = ?", (decision_id,)).fetchone()[0] or "{}")
+    opts = cur.execute("SELECT id, name FROM options WHERE decision_id = ? ORDER BY id", (decision_id,)).fetchall()
+    crit = cur.execute("SELECT id, name, importance FROM criteria WHERE decision_id = ? ORDER BY id", (decision_id,)).fetchall()
+
+    # names this PATCH removes are free to be re-added by it (e.g. a rename of the casing)
+    live_opts = {_norm(o["name"]) for o in opts} - remove_opts
+    live_crit = {_norm(c["name"]) for c in crit} - remove_crit
+    new_opts = [name for name in new_opts if _norm(name) not in live_opts]
+    new_crit = [c for c in new_crit if _norm(c["name"]) not in live_crit]
+
+    err = check_decision_input(
+        d["question"],
+        [o["name"] for o in opts if _norm(o["name"]) not in remove_opts] + new_opts,
+        [c["name"] for c in crit if _norm(c["name"]) not in remove_crit] + new_crit
+    )
+    if err:
+        conn.rollback()
+        conn.close()
+        return {"ok": False, "error": err}, 409
+
+    # cells for an option or criterion the other PATCH already added keep its scores
+    added_opts = {_norm(n) for n in new_opts}
+    added_crit = {_norm(c["name"]) for c in new_crit}
+    matrix = [
+        m for m in matrix
+        if (_norm(m["option"]) in added_opts or _norm(m["criterion"]) in added_crit)
+        and _norm(m["criterion"]) in live_crit | added_crit
+    ]
+
+    if patch_tiers:
+        llm_tiers.setdefault("patch_matrix", []).extend(patch_tiers)
+        cur.execute("UPDATE decisions SET llm_tiers_json = ? WHERE id = ?", (json.dumps(llm_tiers), decision_id))
+        record_llm_outcomes(cur, {"patch_matrix": patch_tiers})
+
+    # take this decision's old contribution out of the aggregates, add the new one back below
+    apply_decision_analytics(cur, decision_analytics_snapshot(cur, decision_id), sign=-1)
+
+    dropped_opt_ids = [(o["id"],) for o in opts if _norm(o["name"]) in remove_opts]
+    cur.executemany("DELETE FROM option_scores WHERE option_id = ?", dropped_opt_ids)
+    cur.executemany("DELETE FROM option_score_reasons WHERE option_id = ?", dropped_opt_ids)
+    cur.executemany("DELETE FROM options WHERE id = ?", dropped_opt_ids)
+
+    if remove_crit:
+        cur.executemany("DELETE FROM criteria WHERE id = ?", [(c["id"],) for c in crit if _norm(c["name"]) in remove_crit])
+        stale = cur.execute(
+            """SELECT os.option_id, os.criterion FROM option_scores os
+               JOIN options o ON o.id = os.option_id
+               WHERE o.decision_id = ?""",
+            (decision_id,)
+        ).fetchall()
+        stale = [(r["option_id"], r["criterion"]) for r in stale if _norm(r["criterion"]) in remove_crit]
+        cur.executemany("DELETE FROM option_scores WHERE option_id = ? AND criterion = ?", stale)
+        cur.executemany("DELETE FROM option_score_reasons WHERE option_id = ? AND criterion = ?", stale)
+
+    cur.executemany(
+        "UPDATE criteria SET importance = ? WHERE id = ?",
+        [(importances[_norm(c["name"])], c["id"]) for c in crit if _norm(c["name"]) in importances]
+    )
+
+    cur.executemany(
+        "INSERT INTO options (decision_id, name, source) VALUES (?, ?, ?)",
+        [(decision_id, name, "manual") for name in new_opts]
+    )
+    cur.executemany(
+        "INSERT INTO criteria (decision_id, name, importance) VALUES (?, ?, ?)",
+        [(decision_id, c["name"], importances.get(_norm(c["name"]), c["importance"])) for c in new_crit]
+    )
+    save_matrix(cur, decision_id, matrix)
+    apply_decision_analytics(cur, decision_analytics_snapshot(cur, decision_id))
+    cur.execute("UPDATE decisions SET version = COALESCE(version, 1) + 1 WHERE id = ?", (decision_id,))
+
+    opts = cur.execute("SELECT id, name FROM options WHERE decision_id = ? ORDER BY id", (decision_id,)).fetchall()
+    crit = cur.execute("SELECT name, importance FROM criteria WHERE decision_id = ? ORDER BY id", (decision_id,)).fetchall()
+    scores = cur.execute(
+        """SELECT o.name as option_name, os.criterion, os.score
+           FROM option_scores os
+           JOIN options o ON o.id = os.option_id
+           WHERE o.decision_id = ?""",
+        (decision_id,)
+    ).fetchall()
+
+    conn.commit()
+    conn.close()
+    invalidate_decision_cache(decision_id)
+
+    ranking = compute_ranking(
+        [{"id": o["id"], "name": o["name"]} for o in opts],
+        [{"name": c["name"], "importance": c["importance"]} for c in crit],
+        [{"option_name": s["option_name"], "criterion": s["criterion"], "score": s["score"]} for s in scores]
+    )
+
+    return {
+        "ok": True,
+        "decision_id": decision_id,
+        "scored_cells": len(matrix),
+        "ranking": ranking,
+        "result_url": f"/decision/{decision_id}/result"
+    }
+
+
+@app.route("/admin/analytics", methods=["GET"])
+@admin_required
+def admin_analytics():
+    conn = get_db()
+    crit_rows = conn.execute(
+        """SELECT decision_type, criterion_key, uses, importance_sum
+           FROM analytics_criteria_by_type WHERE uses > 0
+           ORDER BY decision_type, uses DESC, criterion_key"""
+    ).fetchall()
+    role_rows = conn.execute(
+        """SELECT role_pattern, criterion_key, n, score_sum
+           FROM analytics_role_criterion_scores WHERE n > 0
+           ORDER BY role_pattern, criterion_key"""
+    ).fetchall()
+    llm_rows = conn.execute(
+        "SELECT stage, tier, calls, defaulted_cells FROM analytics_llm_outcomes ORDER BY stage, tier"
+    ).fetchall()
+    conn.close()
+
+    common_criteria = {}
+    for r in crit_rows:
+        top = common_criteria.setdefault(r["decision_type"], [])
+        if len(top) < ANALYTICS_TOP_CRITERIA:
+            top.append({
+                "criterion": r["criterion_key"],
+                "uses": r["uses"],
+                "avg_importance": round(r["importance_sum"] / r["uses"], 2)
+            })
+
+    llm_outcomes = {}
+    for r in llm_rows:
+        st = llm_outcomes.setdefault(r["stage"], {"calls": 0, "fallback": 0, "defaulted_cells": 0, "tiers": {}})
+        st["calls"] += r["calls"]
+        st["defaulted_cells"] += r["defaulted_cells"]
+        st["tiers"][r["tier"]] = r["calls"]
+        if r["tier"] == "fallback":
+            st["fallback"] += r["calls"]
+    for st in llm_outcomes.values():
+        st["fallback_rate"] = round(st["fallback"] / st["calls"], 3) if st["calls"] else 0.0
+
+    return jsonify({
+        "common_criteria": common_criteria,
+        "role_criterion_scores": [
+            {"role_pattern": r["role_pattern"], "criterion": r["criterion_key"], "n": r["n"], "avg_score": round(r["score_sum"] / r["n"], 2)}
+            for r in role_rows
+        ],
+        "llm_outcomes": llm_outcomes
+    })
+
+
+@app.cli.command("rebuild-analytics")
+def rebuild_analytics_command():
+    init_db()
+    conn = get_db()
+    rebuild_analytics(conn)
+    conn.close()
+    click.echo("Rebuilt analytics tables.")
+
+
+@app.cli.command("compile-kb")
+def compile_kb_command():
+    artifact = compile_kb(KB_DOCS)
+    save_kb_artifact(artifact, KB_ARTIFACT_PATH)
+    click.echo(f"Compiled {len(artifact['docs'])} KB docs -> {KB_ARTIFACT_PATH}")
+
+
+@app.cli.command("batch-decisions")
+@click.argument("path")
+@click.option("--user-id", type=int, required=True)
+@click.option("--format", "fmt", type=click.Choice(["jsonl", "csv"]), default=None)
+def batch_decisions_command(path, user_id, fmt):
+    fmt = fmt or ("csv" if path.lower().endswith(".csv") else "jsonl")
+    with open(path, encoding="utf-8") as f:
+        items = parse_batch_items(f.read(), fmt)
+
+    init_db()
+    for res in run_decision_batch(user_id, items):
+        click.echo(json.dumps(res, ensure_ascii=False))
+
+
 if __name__ == "__main__":
     init_db()
     app.run(debug=True)
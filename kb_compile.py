@@ -0,0 +1,97 @@
+import os
+import pickle
+import hashlib
+
+from kb_suggest import parse_sections
+
+
+# bump whenever the feature layout below changes; stale artifacts are rebuilt on load
+KB_ARTIFACT_VERSION = 2
+
+KB_CONTEXT_DOC_CHARS = 900
+
+# question trigger words -> keywords looked up in the doc text (used by pick_scoring_docs)
+SCORING_KEYWORD_GROUPS = [
+    (["stability", "security"], ["stability", "security", "job security"]),
+    (["salary", "pay", "package"], ["salary", "pay", "compensation", "income"]),
+    (["growth", "career"], ["growth", "career", "promotion"]),
+    (["pressure", "stress"], ["pressure", "stress", "work pressure"]),
+]
+
+SCORING_KEYWORDS = [w for _, kws in SCORING_KEYWORD_GROUPS for w in kws]
+
+
+def keyword_mask(keywords) -> int:
+    mask = 0
+    for i, w in enumerate(SCORING_KEYWORDS):
+        if w in keywords:
+            mask |= 1 << i
+    return mask
+
+
+def compute_doc_features(doc: dict) -> dict:
+    path = doc.get("path") or ""
+    title = doc.get("title") or ""
+    cat = doc.get("category") or ""
+    text = doc.get("text") or ""
+
+    # only what pick_scoring_docs / build_kb_context / role patterns read; the raw text stays in KB_DOCS
+    hint = " ".join([path.lower(), title.lower(), cat.lower()])
+    text_lower = text.lower()
+
+    return {
+        "govt_private_hint": "govt_vs_private" in hint or ("government" in hint and "private" in hint),
+        "kw_bits": sum(1 << i for i, w in enumerate(SCORING_KEYWORDS) if w in text_lower),
+        "length_bonus": min(len(text) // 1000, 5),
+        "sections": parse_sections(text),
+        "context_piece": f"[{cat}] {title}\n{text.strip()[:KB_CONTEXT_DOC_CHARS]}",
+    }
+
+
+def kb_fingerprint(kb_docs: list[dict]) -> str:
+    h = hashlib.sha1()
+    for d in sorted(kb_docs, key=lambda d: d.get("path") or ""):
+        for k in ("path", "title", "category", "text"):
+            h.update((d.get(k) or "").encode("utf-8"))
+            h.update(b"\0")
+    return h.hexdigest()
+
+
+def compile_kb(kb_docs: list[dict]) -> dict:
+    return {
+        "version": KB_ARTIFACT_VERSION,
+        "fingerprint": kb_fingerprint(kb_docs),
+        "docs": {d.get("path") or "": compute_doc_features(d) for d in kb_docs},
+    }
+
+
+def save_kb_artifact(artifact: dict, path: str):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(artifact, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+def load_kb_artifact(path: str):
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        return None
+
+
+def load_or_compile_kb(kb_docs: list[dict], path: str) -> dict:
+    artifact = load_kb_artifact(path)
+    if (
+        isinstance(artifact, dict)
+        and artifact.get("version") == KB_ARTIFACT_VERSION
+        and artifact.get("fingerprint") == kb_fingerprint(kb_docs)
+    ):
+        return artifact
+
+    artifact = compile_kb(kb_docs)
+    try:
+        save_kb_artifact(artifact, path)
+    except OSError as e:
+        print("KB ARTIFACT WRITE FAILED:", e)
+    return artifact
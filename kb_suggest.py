@@ -0,0 +1,142 @@
+import os
+import re
+from functools import lru_cache
+
+
+# KB section headers that list criteria / options, in the different shapes the KB files use
+CRITERIA_SECTIONS = {"criteria templates", "key criteria"}
+OPTION_SECTIONS = {"option role patterns", "option roles"}
+SCENARIO_SECTIONS = {"common decision scenarios", "common scenarios", "common decisions"}
+
+SCENARIO_SPLIT = re.compile(r"\s+(?:vs\.?|versus|→|->)\s+", re.IGNORECASE)
+
+
+def _key(s: str) -> str:
+    return re.sub(r"\s+", " ", re.sub(r"[_\-/]+", " ", (s or "").lower())).strip()
+
+
+def _tokens(s: str) -> set[str]:
+    return {t for t in re.findall(r"[a-z0-9]+", (s or "").lower()) if len(t) > 1}
+
+
+def _trigrams(s: str) -> set[str]:
+    s = f"  {s} "
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+
+def _display(s: str) -> str:
+    s = re.sub(r"\s*\(.*?\)\s*", " ", s.replace("_", " ")).strip()
+    return s[:1].upper() + s[1:] if s.islower() else s
+
+
+def parse_sections(text: str) -> dict[str, list[str]]:
+    sections = {}
+    current = None
+    for raw in (text or "").splitlines():
+        line = raw.strip()
+        if not line:
+            continue
+
+        if line.startswith("### ") and current is not None:
+            sections[current].append(line[4:].strip())
+        elif line.startswith("## "):
+            current = line[3:].strip().lower()
+            sections.setdefault(current, [])
+        elif line.startswith("#"):
+            continue
+        elif line.startswith("- ") and current is not None:
+            sections[current].append(line[2:].strip())
+        elif line.endswith(":") and not line.startswith("-"):
+            current = line[:-1].strip().lower()
+            sections.setdefault(current, [])
+    return sections
+
+
+def doc_decision_type(doc: dict) -> str:
+    m = re.search(r"^Decision Type:\s*(\S+)", doc.get("text") or "", re.MULTILINE)
+    if m:
+        return m.group(1).strip().lower()
+    return os.path.basename(os.path.dirname(doc.get("path") or "")).lower() or "other"
+
+
+class SuggestionIndex:
+    def __init__(self, kb_docs: list[dict], cache_size: int = 2048):
+        self.entries = []
+        self._by_key = {}
+        self.prefix = {}
+        self.trigram = {}
+
+        for doc in kb_docs:
+            dtype = doc_decision_type(doc)
+            for header, items in parse_sections(doc.get("text") or "").items():
+                if header in CRITERIA_SECTIONS:
+                    for item in items:
+                        self._add("criteria", item, dtype)
+                elif header in OPTION_SECTIONS:
+                    for item in items:
+                        self._add("option", item, dtype)
+                elif header in SCENARIO_SECTIONS:
+                    for item in items:
+                        for part in SCENARIO_SPLIT.split(item):
+                            self._add("option", part, dtype)
+
+        for i, e in enumerate(self.entries):
+            for word in [e["key"]] + e["key"].split():
+                for n in range(1, len(word) + 1):
+                    self.prefix.setdefault((e["kind"], word[:n]), set()).add(i)
+            for tg in _trigrams(e["key"]):
+                self.trigram.setdefault((e["kind"], tg), set()).add(i)
+
+        self.suggest = lru_cache(maxsize=cache_size)(self._suggest)
+
+    def _add(self, kind: str, raw: str, dtype: str):
+        text = _display(raw)
+        key = _key(text)
+        if not key or len(key) > 60:
+            return
+
+        e = self._by_key.get((kind, key))
+        if e is None:
+            e = {"kind": kind, "key": key, "text": text, "types": {}, "terms": _tokens(key)}
+            self._by_key[(kind, key)] = e
+            self.entries.append(e)
+        elif text[1:] != text[1:].lower() and e["text"][1:] == e["text"][1:].lower():
+            # keep the casing from scenarios ("MNC") over the role-pattern key ("mnc")
+            e["text"] = text
+        e["types"][dtype] = e["types"].get(dtype, 0) + 1
+
+    def _suggest(self, kind: str, q: str, decision_type: str, question_terms: frozenset, limit: int) -> tuple:
+        q = _key(q)
+
+        if not q:
+            candidates = {i: 0.0 for i, e in enumerate(self.entries) if e["kind"] == kind}
+        else:
+            candidates = {i: 3.0 for i in self.prefix.get((kind, q), ())}
+            for i in candidates:
+                if self.entries[i]["key"].startswith(q):
+                    candidates[i] = 4.0
+
+            if len(q) >= 3:
+                q_tg = _trigrams(q)
+                hits = {}
+                for tg in q_tg:
+                    for i in self.trigram.get((kind, tg), ()):
+                        hits[i] = hits.get(i, 0) + 1
+                for i, n in hits.items():
+                    sim = n / len(q_tg)
+                    if sim >= 0.5 and i not in candidates:
+                        candidates[i] = 2.0 * sim
+
+        ranked = []
+        for i, score in candidates.items():
+            e = self.entries[i]
+            score += 2.0 * (decision_type in e["types"])
+            score += 1.0 * len(e["terms"] & question_terms)
+            score += 0.1 * sum(e["types"].values())
+            ranked.append((-score, e["text"]))
+
+        ranked.sort()
+        return tuple(text for _, text in ranked[:limit])
+
+    def lookup(self, kind: str, q: str = "", decision_type: str = "other", question: str = "", limit: int = 8) -> list[str]:
+        return list(self.suggest(kind, q or "", decision_type or "other", frozenset(_tokens(question)), limit))
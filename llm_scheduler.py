@@ -0,0 +1,140 @@
+import math
+import time
+import threading
+from collections import OrderedDict, deque
+
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+PRIORITY_BATCH = 2
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_BACKGROUND: "background",
+    PRIORITY_BATCH: "batch",
+}
+
+
+class LLMOverloaded(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"LLM queue full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class LLMScheduler:
+    # global cap of `slots` concurrent calls; waiting calls are served by priority,
+    # then round-robin across users so one busy user cannot starve the others
+    def __init__(self, slots: int, initial_service_s: float = 10.0, ewma_alpha: float = 0.2):
+        self.slots = max(1, slots)
+        self.alpha = ewma_alpha
+        self.avg_service = initial_service_s
+
+        self.cond = threading.Condition()
+        self.active = 0
+        self.queues = {p: OrderedDict() for p in PRIORITY_NAMES}
+
+        self.completed = 0
+        self.shed = 0
+        self.waits = {p: {"count": 0, "total_s": 0.0, "max_s": 0.0} for p in PRIORITY_NAMES}
+
+    def run(self, user, priority: int, deadline_s: float, fn):
+        self._acquire(user, priority, deadline_s)
+        t0 = time.monotonic()
+        try:
+            return fn()
+        finally:
+            self._release(time.monotonic() - t0)
+
+    def _queued_ahead(self, priority: int) -> int:
+        return sum(len(q) for p, users in self.queues.items() if p <= priority for q in users.values())
+
+    def _estimate_wait(self, priority: int) -> float:
+        if self.active < self.slots and self._queued_ahead(PRIORITY_BATCH) == 0:
+            return 0.0
+        return (self._queued_ahead(priority) + 1) * self.avg_service / self.slots
+
+    def _acquire(self, user, priority: int, deadline_s: float):
+        ticket = {"granted": False}
+        t0 = time.monotonic()
+
+        with self.cond:
+            est = self._estimate_wait(priority)
+            if est > deadline_s:
+                self.shed += 1
+                raise LLMOverloaded(max(1, math.ceil(est)))
+
+            self.queues[priority].setdefault(user, deque()).append(ticket)
+            self._dispatch()
+
+            while not ticket["granted"]:
+                remaining = deadline_s - (time.monotonic() - t0)
+                if remaining <= 0:
+                    self._drop(user, priority, ticket)
+                    self.shed += 1
+                    raise LLMOverloaded(max(1, math.ceil(self._estimate_wait(priority))))
+                self.cond.wait(remaining)
+
+            w = self.waits[priority]
+            waited = time.monotonic() - t0
+            w["count"] += 1
+            w["total_s"] += waited
+            w["max_s"] = max(w["max_s"], waited)
+
+    def _drop(self, user, priority: int, ticket: dict):
+        q = self.queues[priority].get(user) or ()
+        for i, t in enumerate(q):
+            # by identity: ungranted tickets compare equal as dicts
+            if t is ticket:
+                del q[i]
+                if not q:
+                    del self.queues[priority][user]
+                return
+
+    def _dispatch(self):
+        granted = False
+        while self.active < self.slots:
+            users = next((u for p, u in sorted(self.queues.items()) if u), None)
+            if users is None:
+                break
+
+            user, q = next(iter(users.items()))
+            q.popleft()["granted"] = True
+            self.active += 1
+            granted = True
+
+            if q:
+                users.move_to_end(user)
+            else:
+                del users[user]
+
+        if granted:
+            self.cond.notify_all()
+
+    def _release(self, service_s: float):
+        with self.cond:
+            self.active -= 1
+            self.completed += 1
+            self.avg_service = (1 - self.alpha) * self.avg_service + self.alpha * service_s
+            self._dispatch()
+
+    def metrics(self) -> dict:
+        with self.cond:
+            return {
+                "slots": self.slots,
+                "active": self.active,
+                "queue_depth": {
+                    PRIORITY_NAMES[p]: sum(len(q) for q in users.values()) for p, users in self.queues.items()
+                },
+                "queued_users": len({u for users in self.queues.values() for u in users}),
+                "avg_service_s": round(self.avg_service, 3),
+                "wait": {
+                    PRIORITY_NAMES[p]: {
+                        "count": w["count"],
+                        "avg_s": round(w["total_s"] / w["count"], 3) if w["count"] else 0.0,
+                        "max_s": round(w["max_s"], 3),
+                    }
+                    for p, w in self.waits.items()
+                },
+                "completed": self.completed,
+                "shed": self.shed,
+            }
@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import Future
+
+try:
+    import fcntl
+except ImportError:  # windows: in-process coalescing only
+    fcntl = None
+
+
+def flight_key(payload: dict) -> str:
+    # whitespace-insensitive on the prompt so reformatted-but-identical prompts coalesce
+    norm = dict(payload)
+    if isinstance(norm.get("prompt"), str):
+        norm["prompt"] = " ".join(norm["prompt"].split())
+    return hashlib.sha1(json.dumps(norm, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class SingleFlight:
+    def __init__(self, lock_dir: str | None = None, result_ttl: float = 30.0, poll_s: float = 0.05):
+        self.lock_dir = lock_dir if fcntl is not None else None
+        self.result_ttl = result_ttl
+        self.poll_s = poll_s
+        self._last_sweep = 0.0
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+        if self.lock_dir:
+            os.makedirs(self.lock_dir, exist_ok=True)
+
+    def do(self, key: str, fn, timeout: float):
+        with self._lock:
+            fut = self._inflight.get(key)
+            leader = fut is None
+            if leader:
+                fut = Future()
+                self._inflight[key] = fut
+
+        if not leader:
+            # re-raises the leader's exception, or TimeoutError if it takes too long
+            return fut.result(timeout=timeout)
+
+        try:
+            result = self._run(key, fn, timeout)
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        else:
+            fut.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def _run(self, key: str, fn, timeout: float):
+        if not self.lock_dir:
+            return fn()
+
+        # cross-process: whoever holds the file lock generates; processes that were already
+        # queued on the lock pick up its result file. the file is only trusted if it was written
+        # after this call started waiting, so it never acts as a cache for later calls.
+        # a failed leader leaves no result, so the next process in line simply tries itself.
+        base = os.path.join(self.lock_dir, key)
+        started_ns = time.time_ns()
+        lf = self._acquire_file(base + ".lock", time.monotonic() + timeout)
+        try:
+            cached = self._read_result(base + ".json", started_ns)
+            if cached is not None:
+                return cached
+            result = fn()
+            self._write_result(base + ".json", result)
+            return result
+        finally:
+            # unlinked while still held: a waiter on the old inode notices and relocks the new path
+            self._unlink(base + ".lock")
+            lf.close()
+            self._sweep()
+
+    def _acquire_file(self, path: str, deadline: float):
+        while True:
+            lf = open(path, "a+")
+            try:
+                while True:
+                    try:
+                        fcntl.flock(lf, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if time.monotonic() >= deadline:
+                            raise TimeoutError(f"single-flight lock wait exceeded for {os.path.basename(path)}")
+                        time.sleep(self.poll_s)
+
+                try:
+                    if os.stat(path).st_ino == os.fstat(lf.fileno()).st_ino:
+                        return lf
+                except FileNotFoundError:
+                    pass
+            except BaseException:
+                lf.close()
+                raise
+            lf.close()
+
+    def _read_result(self, path: str, since_ns: int):
+        try:
+            if os.stat(path).st_mtime_ns < since_ns:
+                return None
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)["result"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write_result(self, path: str, result):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"result": result}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def _unlink(self, path: str):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def _sweep(self):
+        # result files only matter to waiters queued at the time; drop them once nobody can still be waiting,
+        # along with tmp files and lock files left behind by a crashed process
+        now = time.time()
+        if now - self._last_sweep < self.result_ttl:
+            return
+        self._last_sweep = now
+
+        try:
+            entries = list(os.scandir(self.lock_dir))
+        except OSError:
+            return
+        for e in entries:
+            try:
+                if now - e.stat().st_mtime <= self.result_ttl:
+                    continue
+                if e.name.endswith(".lock"):
+                    with open(e.path, "a+") as lf:
+                        fcntl.flock(lf, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        self._unlink(e.path)
+                elif e.name.endswith((".json", ".tmp")):
+                    self._unlink(e.path)
+            except OSError:
+                continue
@@ -7,6 +7,12 @@ let criteriaSubmitted = false;
 
 let modalMode = null;
 
+// speculative prepare: extraction + KB retrieval run while options/criteria are being added.
+// only fired when the question is locked, so typing never costs an LLM call
+let prepareToken = null;
+let preparedQuestion = "";
+let prepareCtrl = null;
+
 function showToast(msg){
   $("toastText").textContent = msg;
   $("toast").style.display = "flex";
@@ -29,7 +35,8 @@ function escapeHtml(str){
   return (str || "")
     .replaceAll("&","&amp;")
     .replaceAll("<","&lt;")
-    .replaceAll(">","&gt;");
+    .replaceAll(">","&gt;")
+    .replaceAll("\"","&quot;");
 }
 
 function renderPills(){
@@ -77,26 +84,82 @@ function addManualItem(mode){
   renderPills();
 }
 
-function addSystemSuggestions(mode){
-  if(mode === "option"){
-    const samples = ["Option A", "Option B", "Option C"];
-    samples.forEach(s => options.push(s));
-    optionsSubmitted = false;
-    $("optionsStatus").textContent = "System suggested options added (prototype).";
-  } else {
-    const samples = [
-      { name: "Cost", importance: 4 },
-      { name: "Performance", importance: 4 },
-      { name: "Convenience", importance: 3 }
-    ];
-    samples.forEach(s => criteria.push(s));
-    criteriaSubmitted = false;
-    $("criteriaStatus").textContent = "System suggested criteria added (prototype).";
+async function fetchSuggestions(kind, q, limit){
+  const params = new URLSearchParams({
+    kind,
+    q: q || "",
+    question: ($("decisionInput").value || "").trim(),
+    limit: String(limit || 8),
+  });
+  const res = await fetch(`/decision/suggest?${params}`);
+  const out = await res.json();
+  return (res.ok && out.ok) ? out.suggestions : [];
+}
+
+async function addSystemSuggestions(mode){
+  try{
+    if(mode === "option"){
+      const have = new Set(options.map(o => o.toLowerCase()));
+      const picked = (await fetchSuggestions("option", "", 8)).filter(s => !have.has(s.toLowerCase())).slice(0, 3);
+      picked.forEach(s => options.push(s));
+      optionsSubmitted = false;
+      $("optionsStatus").textContent = picked.length ? "System suggested options added." : "No option suggestions found.";
+    } else {
+      const have = new Set(criteria.map(c => c.name.toLowerCase()));
+      const picked = (await fetchSuggestions("criteria", "", 8)).filter(s => !have.has(s.toLowerCase())).slice(0, 3);
+      picked.forEach(s => criteria.push({ name: s, importance: 3 }));
+      criteriaSubmitted = false;
+      $("criteriaStatus").textContent = picked.length ? "System suggested criteria added." : "No criteria suggestions found.";
+    }
+  }catch{
+    showToast("Suggestions unavailable");
   }
   renderPills();
 }
 
+function attachTypeahead(inputId, listId, kind){
+  let timer = null;
+  $(inputId).addEventListener("input", () => {
+    clearTimeout(timer);
+    timer = setTimeout(async () => {
+      try{
+        const list = await fetchSuggestions(kind, $(inputId).value, 8);
+        $(listId).innerHTML = list.map(s => `<option value="${escapeHtml(s)}"></option>`).join("");
+      }catch{
+        $(listId).innerHTML = "";
+      }
+    }, 80);
+  });
+}
+
+async function prepareDecision(){
+  const question = ($("decisionInput").value || "").trim();
+  if(question.length < 10 || question === preparedQuestion) return;
+
+  if(prepareCtrl) prepareCtrl.abort();
+  prepareCtrl = new AbortController();
+
+  try{
+    const res = await fetch("/decision/prepare", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ question }),
+      signal: prepareCtrl.signal,
+    });
+    const out = await res.json();
+    if(res.ok && out.ok){
+      prepareToken = out.prepare_token;
+      preparedQuestion = question;
+    }
+  }catch{
+    // aborted or failed: submit just does the extraction itself
+  }
+}
+
 document.addEventListener("DOMContentLoaded", () => {
+  attachTypeahead("optionManualInput", "optionSuggestList", "option");
+  attachTypeahead("criteriaManualInput", "criteriaSuggestList", "criteria");
+
   $("lockDecisionBtn").addEventListener("click", () => {
     const text = $("decisionInput").value.trim();
     if(!text){
@@ -111,6 +174,7 @@ document.addEventListener("DOMContentLoaded", () => {
 
     $("decisionInputWrap").style.display = "none";
     $("decisionLockedWrap").style.display = "block";
+    prepareDecision();
 
     setTimeout(() => {
       const btn = $("copyDecisionBtn");
@@ -225,6 +289,7 @@ document.addEventListener("DOMContentLoaded", () => {
 
     const question = $("decisionInput").value.trim();
     const payload = { question, options, criteria };
+    if (prepareToken && question === preparedQuestion) payload.prepare_token = prepareToken;
 
     $("finalHint").textContent = "Saving...";
     $("finalSubmitBtn").disabled = true;